@@ -1,199 +1,664 @@
 import subprocess
+import ctypes
+import errno
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import plistlib
 import os
 import shutil
+import sys
+import tempfile
 
 
 class IconHandler:
+    # Locations of the command line tools we use, shared by every instance
+    _toolPaths = {}
+
+    # Extended attributes that codesign rejects as "detritus" or that block launching
+    _problemXattrs = (
+        "com.apple.quarantine",
+        "com.apple.FinderInfo",
+        "com.apple.ResourceFork",
+    )
+    _libc = None
+
+    # Bundles inside the app that carry their own signature, and the folders
+    # they live in. Anything similar elsewhere, e.g. in Resources, is sealed
+    # as a plain resource.
+    _nestedBundleExtensions = (".framework", ".app", ".appex", ".xpc", ".bundle")
+    _nestedCodeDirs = (
+        "Frameworks",
+        "PlugIns",
+        "XPCServices",
+        "LoginItems",
+        "Helpers",
+        "MacOS",
+    )
+
+    # actool options that are the same for every icon we compile
+    _actoolArgs = (
+        "--platform",
+        "macosx",
+        "--output-partial-info-plist",
+        "assetcatalog_generated_info.plist",
+        "--minimum-deployment-target",
+        "26.0",
+        "--enable-on-demand-resources",
+        "NO",
+        "--include-all-app-icons",
+    )
+
+    # Runs the pipeline off the calling thread, one bundle at a time
+    _backgroundExecutor = ThreadPoolExecutor(max_workers=1)
+
     def __init__(
-        self, appBundlePath, iconBundlePath, cliBased=True, verboseErrors=False
+        self,
+        appBundlePath,
+        iconBundlePath,
+        cliBased=True,
+        verboseErrors=False,
+        runInBackground=False,
+        loggingEnabled=True,
     ):
         """This class holds the functions to add a .icon file into a usable MacOS application
 
         Args:
             cliBased (bool, optional): Set False if this is the backend of a UI, leave as True for . Defaults to True.
             verboseErrors (bool, optional): Set True for verbose terminal messages. Please note, cliBased needs to be set as True.
+            runInBackground (bool, optional): Set True to run the pipeline on a worker thread so a UI event loop isn't blocked. The result is available from self.future. Defaults to False.
+            loggingEnabled (bool, optional): Set False to silence all terminal messages. Defaults to True.
         """
         # Sets some variables that other functions use
+        self.loggingEnabled = loggingEnabled
         self.cliBased = cliBased
         self.verboseErrors = verboseErrors
 
         self.appBundlePath = appBundlePath
         self.iconBundlePath = iconBundlePath
 
-        self.validateData()
+        # Paths inside the bundle that the other functions keep coming back to
+        self._bundle = Path(self.appBundlePath).absolute()
+        self._contents = self._bundle / "Contents"
+        self._resources = self._contents / "Resources"
+
+        self.clearScreen()
+
+        # Fingerprint of the inputs as of the last successful run
+        self._statePath = (
+            self._bundle.resolve().parent / f".{self._bundle.name}.logo-liquify-state"
+        )
+
+        if runInBackground:
+            # A UI can poll this or use add_done_callback to emit a signal
+            self.future = self._backgroundExecutor.submit(self.run)
+        else:
+            self.future = None
+            self.run()
+
+    def run(self):
+        """Compiles the icon, adds it to the app bundle and re-signs the app if needed.
+
+        Returns:
+            bool: True on success, False if validation, compiling the icon or re-signing failed.
+        """
+        state = self.bundleState()
+        if state is not None and state == self.loadState():
+            self.logMessage("Icon and bundle unchanged since the last run, nothing to do.")
+            return True
+
+        if not self.validateData():
+            return False
 
-        self.compileIcon(self.iconBundlePath)
-        self.updateInfoPlist(f"{self.appBundlePath}/Contents/Info.plist")
+        if not self.compileIcon(self.iconBundlePath):
+            return False
+        bundleBefore = self.snapshotBundle()
+        self.updateInfoPlist(self._contents / "Info.plist")
         self.moveIconToApp()
-        self.resignAppForLocalUse()
+
+        # Only re-sign when the icon swap actually changed the bundle
+        codeSigDir = self._contents / "_CodeSignature"
+        if bundleBefore != self.snapshotBundle() or not codeSigDir.exists():
+            success = self.resignAppForLocalUse()
+        else:
+            self.logMessage("Bundle unchanged, skipping re-sign.")
+            success = True
+
+        if success:
+            self.saveState()
+        return success
 
     def logMessage(self, simpleMessage, verboseMessage=""):
         """This function controls the logging. By using this instead of print or a log to file, we can change how all our logging works at once.
 
         Args:
             simpleMessage (str): A simple message that will show on the terminal if an error occurs to point the user in the right direction.
-            verboseMessage (str, optional): A second message that shows after the simpleMessage. Only shows if verbose logs are enabled. Defaults to "".
+            verboseMessage (str or callable, optional): A second message that shows after the simpleMessage. Only shows if verbose logs are enabled. Pass a function returning the string to skip building large messages when they won't be shown. Defaults to "".
         """
 
-        if self.logMessage:
+        if self.loggingEnabled:
             print(simpleMessage)
             if self.verboseErrors and verboseMessage != "":
+                if callable(verboseMessage):
+                    verboseMessage = verboseMessage()
                 print(f"    {verboseMessage}")
 
     def clearScreen(self):
-        """Cleares the terminal"""
-        subprocess.run(["clear"])
+        """Cleares the terminal, does nothing when used as the backend of a UI"""
+        if self.cliBased:
+            sys.stdout.write("\033[2J\033[H")
+            sys.stdout.flush()
 
     def validateData(self, appBundlePath=""):
         """This function validates necessary requirements are installed, past python modules.
 
         Args:
             appBundlePath (str, optional): The path of the app bundle, leave blank to use the class defined variables. Defaults to "".
+
+        Returns:
+            bool: True if actool is installed and the bundle's Contents folder exists.
         """
 
         if appBundlePath == "":
-            appBundlePath = self.appBundlePath
-
-        self.clearScreen()
+            contentsPath = self._contents
+        else:
+            contentsPath = Path(appBundlePath) / "Contents"
 
-        # Check actool is mentioned
-        actoolsCMD = subprocess.run(["actool"], capture_output=True, text=True)
-        if (
-            actoolsCMD.stderr
-            == "Error: No arguments specified, please consult `man actool` in Terminal."
-        ):
-            actoolsInstalled = False
+        # Check actool is installed
+        actoolsInstalled = self.findTool("actool") is not None
+        if not actoolsInstalled:
             self.logMessage(
                 "Please install Xcode command line tools",
                 'Error finding "actool" please ensure Xcode is fully installed. It may need a re-install.',
             )
         else:
-            actoolsInstalled = True
             self.logMessage(
                 "Xcode CLI Tools installed already.", "Actool has been located."
             )
 
-        self.validatePath(f"{appBundlePath}/Contents")
+        return self.validatePath(contentsPath) and actoolsInstalled
+
+    @classmethod
+    def findTool(cls, toolName):
+        """Looks up a command line tool on the PATH, caching it once it has been found.
+
+        Missing tools aren't cached, so installing Xcode while a UI is open is picked up.
+
+        Args:
+            toolName (str): The name of the tool, e.g. "actool".
+
+        Returns:
+            str: The full path of the tool, or None if it isn't installed.
+        """
+        toolPath = cls._toolPaths.get(toolName)
+        if toolPath is None:
+            toolPath = shutil.which(toolName)
+            if toolPath is not None:
+                cls._toolPaths[toolName] = toolPath
+        return toolPath
+
+    def runCommand(self, cmd):
+        """Runs a command, only keeping its output when verbose errors are enabled.
+
+        Args:
+            cmd (list): The command and its arguments.
+
+        Returns:
+            subprocess.CompletedProcess: The result, stdout and stderr are None unless verboseErrors is set.
+        """
+        output = subprocess.PIPE if self.verboseErrors else subprocess.DEVNULL
+        return subprocess.run(cmd, stdout=output, stderr=output, text=self.verboseErrors)
 
     def validatePath(self, filePath):
-        try:
-            Path(filePath).resolve(strict=False)
+        """Checks a path exists, logging an error if it doesn't.
+
+        Args:
+            filePath (str or Path): The path to check.
+
+        Returns:
+            bool: True if the path exists.
+        """
+        if Path(filePath).exists():
             return True
-        except (OSError, RuntimeError, ValueError) as e:
-            self.logMessage(f"Error finding the path {filePath}", f"The error was: {e}")
-            return False
 
-    def compileIcon(self, iconPath):
+        self.logMessage(
+            f"Error finding the path {filePath}", "The path does not exist."
+        )
+        return False
+
+    def snapshotBundle(self, appBundlePath=""):
+        """Lists the size and mtime of the Info.plist and everything under Resources, including oldFiles, the parts of the bundle an icon swap touches.
+
+        Args:
+            appBundlePath (str, optional): The path of the app bundle, leave blank to use the class defined variables. Defaults to "".
+
+        Returns:
+            dict: Maps each file's path relative to Contents to its (st_size, st_mtime_ns).
+        """
+        if appBundlePath == "":
+            contentsPath = self._contents
+        else:
+            contentsPath = Path(appBundlePath).absolute() / "Contents"
+
+        snapshot = {}
+        infoPlistPath = contentsPath / "Info.plist"
+        if infoPlistPath.is_file():
+            infoPlistStat = infoPlistPath.stat()
+            snapshot["Info.plist"] = (infoPlistStat.st_size, infoPlistStat.st_mtime_ns)
+
+        directories = [contentsPath / "Resources"]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    else:
+                        entryStat = entry.stat(follow_symlinks=False)
+                        snapshot[os.path.relpath(entry.path, contentsPath)] = (
+                            entryStat.st_size,
+                            entryStat.st_mtime_ns,
+                        )
+
+        return snapshot
+
+    def warmFileCache(self, bundleFiles):
+        """Reads every file in the bundle in parallel so codesign's serial hashing reads from the page cache.
+
+        Args:
+            bundleFiles (list): The files in the bundle, from listBundle.
+        """
+
+        def readFile(filePath):
+            buffer = bytearray(1 << 20)
+            try:
+                with open(filePath, "rb", buffering=0) as f:
+                    while f.readinto(buffer):
+                        pass
+            except OSError:
+                # codesign will report anything it really can't read
+                pass
+
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(readFile, bundleFiles))
+
+    def bundleState(self):
+        """Fingerprints the icon package contents, Info.plist, resources and signature by path and mtime.
+
+        Returns:
+            str: A blake2b hex digest of the state, or None if part of it is missing.
+        """
         try:
-            shutil.rmtree("./OutputDir")
-        except FileNotFoundError:
-            # The directory does not exist so we can move straight to creating one
-            pass
-        os.mkdir("./OutputDir")
+            state = [
+                os.path.abspath(self.iconBundlePath),
+                os.stat(self.iconBundlePath).st_mtime_ns,
+                self.iconState(),
+                os.stat(self._contents / "Info.plist").st_mtime_ns,
+                os.stat(self._contents / "_CodeSignature" / "CodeResources").st_mtime_ns,
+            ]
+            with os.scandir(self._resources) as entries:
+                state.extend(
+                    sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries)
+                )
+        except OSError:
+            return None
+
+        return hashlib.blake2b(repr(state).encode()).hexdigest()
+
+    def iconState(self):
+        """Lists every file in the .icon package, since editing one doesn't change the package's own mtime.
+
+        Returns:
+            list: (relative path, st_mtime_ns, st_size) for each file, sorted by path.
+        """
+        iconFiles = []
+        for root, dirs, files in os.walk(self.iconBundlePath):
+            for f in files:
+                filePath = os.path.join(root, f)
+                fileStat = os.stat(filePath)
+                iconFiles.append(
+                    (
+                        os.path.relpath(filePath, self.iconBundlePath),
+                        fileStat.st_mtime_ns,
+                        fileStat.st_size,
+                    )
+                )
+
+        return sorted(iconFiles)
+
+    def loadState(self):
+        try:
+            with open(self._statePath, "r") as stateFile:
+                return stateFile.read().strip()
+        except OSError:
+            return None
+
+    def saveState(self):
+        # Stored next to the bundle, a new file inside it would break the signature
+        state = self.bundleState()
+        if state is None:
+            return
+        try:
+            with open(self._statePath, "w") as stateFile:
+                stateFile.write(state)
+        except OSError as e:
+            self.logMessage("Could not save the bundle state.", f"The error was: {e}")
 
+    def compileIcon(self, iconPath):
         if not self.validatePath(iconPath):
             # The path was reported as not valid
-            return
+            return False
+
+        actoolPath = self.findTool("actool")
+        if not actoolPath:
+            # validateData has already told the user to install Xcode
+            return False
+
+        # Compile into a fresh directory next to ./OutputDir and swap it in at
+        # the end, so the output is never left half written
+        path = tempfile.mkdtemp(prefix=".OutputDir-", dir=".")
 
         # If we are here the path worked, and now we run actool
         self.iconName = iconPath.split("/")[-1].split(".")[0]
-        actoolResponse = subprocess.run(
+        actoolResponse = self.runCommand(
             [
-                "actool",
+                actoolPath,
                 iconPath,
                 "--compile",
-                "./OutputDir",
+                path,
                 "--app-icon",
                 self.iconName,
-                "--platform",
-                "macosx",
-                "--output-partial-info-plist",
-                "assetcatalog_generated_info.plist",
-                "--minimum-deployment-target",
-                "26.0",
-                "--enable-on-demand-resources",
-                "NO",
-                "--include-all-app-icons",
-            ],
-            capture_output=True,
-            text=True,
+                *self._actoolArgs,
+            ]
         )
 
+        # Leave any previous ./OutputDir alone if actool didn't produce a catalog
+        if actoolResponse.returncode != 0 or not os.path.isfile(
+            os.path.join(path, "Assets.car")
+        ):
+            shutil.rmtree(path, ignore_errors=True)
+            self.logMessage(
+                "Failed to compile the icon.",
+                lambda: f"stdout: {actoolResponse.stdout}\n\nstderr: {actoolResponse.stderr}",
+            )
+            return False
+
         self.logMessage(
             "Icon compiled in ./OutputDir",
-            f"stdout: {actoolResponse.stdout}\n\nstderr: {actoolResponse.stderr}",
+            lambda: f"stdout: {actoolResponse.stdout}\n\nstderr: {actoolResponse.stderr}",
         )
 
-        path = "./OutputDir"
-        files = os.listdir(path)
-        for index, file in enumerate(files):
-            old_path = os.path.join(path, file)
-
-            name, ext = os.path.splitext(file)  # keeps original extension
-            new_name = f"AppIcon{ext}"
+        renames = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)  # keeps original extension
+                new_path = os.path.join(path, f"AppIcon{ext}")
 
-            new_path = os.path.join(path, new_name)
+                if ext != ".car":
+                    renames.append((entry.path, new_path))
 
-            if ext != ".car":
+        # Only worth spinning up threads when actool produced a lot of files
+        if len(renames) > 8:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda paths: os.rename(*paths), renames))
+        else:
+            for old_path, new_path in renames:
                 os.rename(old_path, new_path)
 
+        # os.replace can't overwrite a non-empty directory, so move the old
+        # output aside first and remove it once the new one is in place
+        stalePath = tempfile.mkdtemp(prefix=".OutputDir-old-", dir=".")
+        try:
+            os.replace("./OutputDir", stalePath)
+        except FileNotFoundError:
+            # The directory does not exist so we can move straight to swapping
+            pass
+        os.replace(path, "./OutputDir")
+        shutil.rmtree(stalePath, ignore_errors=True)
+        return True
+
     def findInfoPlist(self, bundlePath):
         pass
 
     def updateInfoPlist(self, infoPlistPath, fallbackIconFile=""):
-        """Set icon metadata without disturbing other plist keys."""
+        """Set icon metadata without disturbing other plist keys.
+
+        The file is only rewritten if the icon keys actually change.
+
+        Returns:
+            bool: True if the plist was rewritten, False if it was already up to date.
+        """
         with open(infoPlistPath, "rb") as plistFile:
-            plistData = plistlib.load(plistFile)
+            rawData = plistFile.read()
+        plistData = plistlib.loads(rawData)
+
+        if plistData.get("CFBundleIconName") == self.iconName and (
+            not fallbackIconFile or plistData.get("CFBundleIconFile") == fallbackIconFile
+        ):
+            return False
 
         plistData["CFBundleIconName"] = self.iconName
         if fallbackIconFile:
             plistData["CFBundleIconFile"] = fallbackIconFile
 
+        # Keep binary plists binary
+        if rawData.startswith(b"bplist"):
+            newData = plistlib.dumps(plistData, fmt=plistlib.FMT_BINARY)
+        else:
+            newData = plistlib.dumps(plistData)
+
+        if newData == rawData:
+            return False
+
         with open(infoPlistPath, "wb") as plistFile:
-            plistlib.dump(plistData, plistFile)
+            plistFile.write(newData)
+        return True
 
     def moveIconToApp(self, appBundlePath=""):
         if appBundlePath == "":
-            appBundlePath = self.appBundlePath
+            resourcesPath = self._resources
+        else:
+            resourcesPath = Path(appBundlePath) / "Contents" / "Resources"
+        oldFilesPath = resourcesPath / "oldFiles"
 
-        allOldFiles = os.listdir(f"{appBundlePath}/Contents/Resources")
+        with os.scandir(resourcesPath) as entries:
+            allOldFiles = [entry for entry in entries if entry.name != "oldFiles"]
         try:
-            os.mkdir(f"{appBundlePath}/Contents/Resources/oldFiles")
+            os.mkdir(oldFilesPath)
         except FileExistsError:
             # Script has probs already ran but we canc ontinue
             pass
-        for f in allOldFiles:
-            if "oldFiles" not in f:
-                shutil.move(
-                    f"{appBundlePath}/Contents/Resources/{f}",
-                    f"{appBundlePath}/Contents/Resources/oldFiles/{f}",
-                )
+        for entry in allOldFiles:
+            self.moveFile(entry.path, oldFilesPath / entry.name)
+
+        # List first, moving entries out while scanning can make readdir skip some
+        with os.scandir("./OutputDir") as entries:
+            allNewFiles = list(entries)
+        for entry in allNewFiles:
+            self.moveFile(entry.path, resourcesPath / entry.name)
+
+    def moveFile(self, sourcePath, destinationPath):
+        """Moves a file with a single rename, copying it instead if the destination is on another volume.
+
+        Args:
+            sourcePath (str or Path): The file to move.
+            destinationPath (str or Path): Where to move it to.
+        """
+        try:
+            os.replace(sourcePath, destinationPath)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # e.g. the app is on an external drive and ./OutputDir isn't
+            shutil.move(sourcePath, destinationPath)
+
+    def listBundle(self, bundlePath):
+        """Walks the bundle once so every signing step can share the same listing.
+
+        Args:
+            bundlePath (Path): The path of the app bundle.
+
+        Returns:
+            tuple: Lists of the directories and files in the bundle, parents listed before their children.
+        """
+        bundleDirs = []
+        bundleFiles = []
+        for root, dirs, files in os.walk(bundlePath):
+            rootPath = Path(root)
+            bundleDirs.extend(rootPath / d for d in dirs)
+            bundleFiles.extend(rootPath / f for f in files)
+
+        return bundleDirs, bundleFiles
+
+    def collectCodeObjects(self, bundlePath, bundleDirs, bundleFiles):
+        """Find the nested code objects that need their own signature.
+
+        Only executables in Contents/MacOS, nested bundles (frameworks, helper
+        apps, extensions, XPC services and plug-ins) in the standard nested
+        code folders and loose .dylib/.so files
+        are returned, so codesign never has to re-hash plain resource files
+        more than once. The bundle itself is not included.
+
+        Args:
+            bundlePath (Path): The path of the app bundle.
+            bundleDirs (list): The directories in the bundle, from listBundle.
+            bundleFiles (list): The files in the bundle, from listBundle.
+
+        Returns:
+            list: Paths of the code objects inside the bundle.
+        """
+        codeObjects = []
+        mainExecutableDir = bundlePath / "Contents" / "MacOS"
+
+        # A nested bundle is signed as a whole, so nothing inside it is
+        # collected on its own
+        sealedDirs = set()
+        for d in bundleDirs:
+            if d.parent in sealedDirs:
+                sealedDirs.add(d)
+            elif (
+                d.name.endswith(self._nestedBundleExtensions)
+                and d.parent.name in self._nestedCodeDirs
+            ):
+                codeObjects.append(d)
+                sealedDirs.add(d)
+
+        for f in bundleFiles:
+            if f.parent in sealedDirs:
+                continue
+            if f.parent == mainExecutableDir or f.name.endswith((".dylib", ".so")):
+                codeObjects.append(f)
+
+        return codeObjects
+
+    def pruneBuildArtifacts(self, bundleDirs, bundleFiles):
+        """Remove leftover build products that codesign would otherwise reject.
+
+        Args:
+            bundleDirs (list): The directories in the bundle, from listBundle.
+            bundleFiles (list): The files in the bundle, from listBundle.
+
+        Returns:
+            tuple: The directories and files still in the bundle afterwards.
+        """
+        removedDirs = set()
+        keptDirs = []
+        for d in bundleDirs:
+            if d.parent in removedDirs:
+                removedDirs.add(d)
+            elif d.name == "objects-Release":
+                shutil.rmtree(d, ignore_errors=True)
+                removedDirs.add(d)
+            else:
+                keptDirs.append(d)
+
+        keptFiles = []
+        for f in bundleFiles:
+            if f.parent in removedDirs:
+                continue
+            if f.name.endswith((".o", ".a")):
+                try:
+                    os.remove(f)
+                    continue
+                except OSError as e:
+                    self.logMessage(
+                        f"Could not remove the build artifact {f.name}",
+                        f"The error was: {e}",
+                    )
+            keptFiles.append(f)
+
+        return keptDirs, keptFiles
+
+    def removeXattr(self, path, attrName):
+        """Removes a single extended attribute from a path without following symlinks.
+
+        os.removexattr only exists on Linux, so on macOS this calls removexattr from libc.
+
+        Args:
+            path (str): The file or directory to clean.
+            attrName (str): The attribute to remove.
+
+        Raises:
+            OSError: If the attribute isn't set or can't be removed.
+        """
+        if hasattr(os, "removexattr"):
+            os.removexattr(path, attrName, follow_symlinks=False)
+            return
+
+        if IconHandler._libc is None:
+            IconHandler._libc = ctypes.CDLL(None, use_errno=True)
+
+        XATTR_NOFOLLOW = 0x0001
+        if (
+            IconHandler._libc.removexattr(
+                os.fsencode(path), attrName.encode(), XATTR_NOFOLLOW
+            )
+            != 0
+        ):
+            errorNumber = ctypes.get_errno()
+            raise OSError(errorNumber, os.strerror(errorNumber), path)
+
+    def cleanXattrs(self, paths):
+        """Removes the extended attributes that break codesign from everything in the bundle.
+
+        Args:
+            paths (list): The bundle and every directory and file inside it.
+        """
+
+        def cleanPath(path):
+            for attrName in self._problemXattrs:
+                try:
+                    self.removeXattr(path, attrName)
+                except OSError:
+                    # Most files don't have the attribute set
+                    pass
 
-        allFiles = os.listdir("./OutputDir")
-        for f in allFiles:
-            shutil.move(f"./OutputDir/{f}", f"{appBundlePath}/Contents/Resources/{f}")
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(cleanPath, paths))
 
-    def resignAppForLocalUse(self, appBundlePath="", identity="-"):
+    def resignAppForLocalUse(self, appBundlePath="", identity="-", parallelism=None):
         """Remove stale signatures and re-sign the app bundle for local use.
 
         Args:
             appBundlePath (str, optional): Override bundle path; defaults to class value.
             identity (str, optional): codesign identity, '-' for ad-hoc. Defaults to '-'.
+            parallelism (int, optional): Max concurrent codesign processes, 1 to sign serially. Non ad-hoc identities always sign serially. Defaults to min(32, cpu count + 4).
 
         Returns:
             bool: True on success, False if codesign is unavailable or fails.
         """
 
         if appBundlePath == "":
-            appBundlePath = self.appBundlePath
-
-        bundlePath = Path(appBundlePath)
+            bundlePath = self._bundle
+        else:
+            bundlePath = Path(appBundlePath)
         if not self.validatePath(bundlePath):
             return False
 
-        codesignPath = shutil.which("codesign")
+        codesignPath = self.findTool("codesign")
         if not codesignPath:
             self.logMessage(
                 "codesign not found. Please install Xcode Command Line Tools.",
@@ -206,26 +671,80 @@ class IconHandler:
         if codeSigDir.exists():
             shutil.rmtree(codeSigDir, ignore_errors=True)
 
-        # Clean extended attributes that can break codesign
-        xattrPath = shutil.which("xattr")
-        if xattrPath:
-            subprocess.run([xattrPath, "-cr", str(bundlePath)], capture_output=True)
+        # Walk the bundle once and share the listing between the steps below
+        bundleDirs, bundleFiles = self.pruneBuildArtifacts(
+            *self.listBundle(bundlePath)
+        )
+
+        # Clean extended attributes that can break codesign and pre-read the
+        # bundle, overlapping both with finding the code objects since none of
+        # them change the tree
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            xattrCleaning = executor.submit(
+                self.cleanXattrs, [bundlePath, *bundleDirs, *bundleFiles]
+            )
+            cacheWarming = executor.submit(self.warmFileCache, bundleFiles)
+
+            # Sign nested code objects inner-most first so each outer signature
+            # seals already-signed inner code, then seal the bundle itself.
+            # codesign accepts several paths, so one call covers a whole depth.
+            depthBuckets = {}
+            for codeObject in self.collectCodeObjects(
+                bundlePath, bundleDirs, bundleFiles
+            ):
+                depth = len(codeObject.relative_to(bundlePath).parts)
+                depthBuckets.setdefault(depth, []).append(str(codeObject))
+
+            xattrCleaning.result()
+            cacheWarming.result()
+
+        # Hardware and keychain identities can prompt or fail when used from
+        # several processes at once, so only ad-hoc signing runs in parallel.
+        if parallelism is None:
+            parallelism = min(32, (os.cpu_count() or 1) + 4)
+        if identity != "-":
+            parallelism = 1
+
+        def signPaths(paths):
+            return self.runCommand(
+                [codesignPath, "--force", "--sign", identity, *paths]
+            )
 
-        cmd = [codesignPath, "--force", "--deep", "--sign", identity, str(bundlePath)]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            for depth in sorted(depthBuckets, reverse=True):
+                # Siblings at one depth are independent, but every one of them
+                # must be signed before the shallower depth is started.
+                bucket = depthBuckets[depth]
+                workers = min(max(1, parallelism), len(bucket))
+                chunks = [bucket[i::workers] for i in range(workers)]
+                for result in executor.map(signPaths, chunks):
+                    if result.returncode != 0:
+                        self.logMessage(
+                            f"Failed to sign the code objects at depth {depth}.",
+                            lambda: f"stdout: {result.stdout}\n\nstderr: {result.stderr}",
+                        )
+                        return False
+
+        cmd = [codesignPath, "--force", "--sign", identity, str(bundlePath)]
+        result = self.runCommand(cmd)
 
         if result.returncode != 0:
             self.logMessage(
                 "Failed to re-sign the application.",
-                f"stdout: {result.stdout}\n\nstderr: {result.stderr}",
+                lambda: f"stdout: {result.stdout}\n\nstderr: {result.stderr}",
             )
             return False
 
         self.logMessage(
             "App re-signed for local use.",
-            f"stdout: {result.stdout}\n\nstderr: {result.stderr}",
+            lambda: f"stdout: {result.stdout}\n\nstderr: {result.stderr}",
         )
         return True
 
 
-IconHandler("path/to/your.app", "path/to/your.icon")
+def main():
+    IconHandler("path/to/your.app", "path/to/your.icon")
+
+
+if __name__ == "__main__":
+    main()